@@ -18,11 +18,24 @@
 # Written by W.J.M. Nelis, wim.nelis@ziggo.nl, 2023.03
 #
 import calendar				# Inverse of time.gmtime
+import importlib.util			# Check availability of modules
 from lxml import etree			# Parse XML document
+import os				# File system access
+import json				# Serialise cached results
 import re				# Recognise and parse strings
-import requests				# Https GET method
 import time
 
+# Module httpx is used for the https GET method if it is installed, as it can
+# use HTTP/2 if module h2 is installed too. Otherwise module requests is used.
+try:
+  import httpx				# Https GET method
+except ImportError:
+  httpx= None
+  import requests			# Https GET method
+  from urllib3.util import Retry	# Retry policy of https requests
+else:
+  use_http2= importlib.util.find_spec( 'h2' ) is not None
+
 
 #
 # Constant definitions.
@@ -31,19 +44,39 @@ import time
 base_url= 'https://web-api.tp.entsoe.eu/api'
 document_type= 'A44'			# Request a price document
 domain  = '10YNL----------L'		# The Netherlands
-xmlns_id= 'entsoe'			# XML default name space identifier
+default_time_out= 30			# Default time-out of a request [s]
+
+# The XML name space of a price document. Documents using another name space are
+# handled too, albeit with some additional set-up upon the first one.
+xmlns_uri= 'urn:iec62325.351:tc57wg16:451-3:publicationdocument:7:3'
 
-# The time stamps found in the XML document are all UTC times. Define their
-# structure, which is needed to parse them.
+# The time stamps found in the XML document are all UTC times, with format
+# 'YYYY-MM-DDThh:mmZ'. The time stamps in the request have format 'YYYYMMDDhh00'.
+# Both formats have fixed-width fields, thus they are parsed and built by hand,
+# which is much faster than time.strptime and time.strftime.
 one_day    = 86400			# Seconds per day
-time_fmt_0 = '%Y%m%d%H00'		# Format to create UTC time string
-time_fmt_1 = '%Y-%m-%dT%H:%MZ'		# Format to parse UTC time string
+
+# The prices for a given period do not change once they are published. Thus the
+# parsed result of a query can be saved on disk and reused, avoiding another
+# round-trip to the ENTSO-E server. A cached result is discarded after some
+# time, to pick up any late corrections. Whenever a result is saved, all expired
+# results are removed from the cache, to limit its size. The results are saved
+# in JSON format, as loading such a file cannot execute code.
+cache_expiry= 2*one_day			# Maximum age of a cached result [s]
 
 # The resolution in the XML document can be expressed in various units. The unit
 # of the resolution is changed to [s], to ease the computations.
 reso_format= re.compile( r'^PT(\d+)([SMH])$' )  # See REST API
 reso_multif= { 'S': 1, 'M': 60, 'H': 3600 }
 
+# Define the patterns to recognise a response without data and a response
+# containing an error report, an acknowledgement document, and to extract the
+# reason from the latter. They are matched against the raw response, to avoid
+# decoding and parsing the full response.
+no_data_pattern= re.compile( rb'No matching data found' )
+ack_pattern    = re.compile( rb'Acknowledgement_MarketDocument' )
+ack_reason     = re.compile( rb'<(?:\w+:)?text>([^<]*)<' )
+
 # Define the scalar fields to be extracted from the XML document. If a value is
 # specified, the named field must have the given value. If the field is missing
 # or if the value is different, an exception is raised. If clean-up is specified
@@ -58,6 +91,31 @@ xml_extract= {
   'eop'     : ( 'TimeSeries/Period/timeInterval/end'  , None , False ),
   'reso'    : ( 'TimeSeries/Period/resolution'        , None , False )
 }
+xml_cleanup= frozenset( k for k,v in xml_extract.items() if v[2] )
+
+# Define the path to the points in the XML document. The schema fixes the order
+# of the fields within a point, position followed by price.amount, thus these
+# fields are accessed by index rather than by name.
+xml_point= 'TimeSeries/Period/Point'
+
+# Define the parser for the XML document. The document does not use xml:id
+# attributes and its whitespace between elements is not significant, thus
+# neither is retained. Entities are not resolved and network access is denied,
+# thus a malicious document cannot cause the parser to fetch external
+# resources. Loading and validation of a DTD are disabled by default in lxml;
+# these options are only stated explicitly.
+xml_parser= etree.XMLParser( collect_ids=False, remove_blank_text=True,
+                             load_dtd=False, dtd_validation=False,
+                             resolve_entities=False, no_network=True )
+
+# The fields and the points are extracted in a single walk through the XML
+# document, which is driven by a table. The table maps the qualified tag of each
+# field onto the key of the field and the qualified tags of its ancestors. It is
+# built once per name space URI and reused for all subsequent documents using
+# the same name space. The table for the name space of the price document is
+# built when the first client is created, the table for any other name space
+# upon its first use.
+xml_tables= {}
 
 
 class entsoeException( Exception ):
@@ -65,45 +123,146 @@ class entsoeException( Exception ):
 
 class entsoe():
 
-  def __init__( self, web_key: str, time_out: int= None ):
+  def __init__( self, web_key: str, time_out: int= None, cache_dir: str= None ):
     assert web_key is not None, 'Illegal web API key'
     self.webkey = web_key
     self.timeout= time_out
+    self.cachedir= cache_dir		# Directory of result cache, None=off
+    if cache_dir is not None:
+      os.makedirs( cache_dir, exist_ok=True )
+  #
+  # Use one client for all requests, allowing a long-running caller to reuse
+  # the connection to the ENTSO-E server, and retry failed requests. HTTP/2 is
+  # used if module httpx is installed with HTTP/2 support. Note that module
+  # httpx only retries failed connection attempts, immediately, while module
+  # requests also retries failed reads, with an exponential back-off.
+  # The errors of either module are reported as an entsoeException.
+    if httpx is not None:
+      transport= httpx.HTTPTransport( http2=use_http2, retries=3 )
+      self._client= httpx.Client( transport=transport, follow_redirects=True )
+      self._errors= ( httpx.HTTPError, )
+    else:
+      self._client= requests.Session()
+      adapter= requests.adapters.HTTPAdapter( pool_connections=1, pool_maxsize=1,
+                 max_retries=Retry( total=3, backoff_factor=0.3 ) )
+      self._client.mount( 'https://', adapter )
+      self._errors= ( requests.RequestException, )
+  #
+    self._get_table( xmlns_uri )	# Prepare to parse price documents
 
  #
- # Private method _add_prefix adds the default name space identifier to each
- # unprefixed node name.
+ # Private method _get_table returns the table which drives the extraction of
+ # the fields from a document with name space URI nsu, which is None if the
+ # document has no name space. The table is built upon the first use of a name
+ # space URI. The key of the points in the table is 'point'.
  #
-  def _add_prefix( self, rp: str, nsi: str ) -> str:
-    if nsi is None:  return rp
-    if nsi == ''  :  return rp
+  def _get_table( self, nsu: str ) -> dict:
+    tbl= xml_tables.get( nsu )
+    if tbl is None:
+      paths= { k: v[0] for k,v in xml_extract.items() }
+      paths['point']= xml_point
+      tbl= {}
+      for k,rp in paths.items():
+        tags= [ etree.QName( nsu, level ).text for level in rp.split('/') ]
+        tbl.setdefault( tags[-1], [] ).append( (k, tuple(reversed(tags[:-1]))) )
+      xml_tables[nsu]= tbl
   #
-    levels= rp.split( '/' )
-    for i,level in enumerate(levels):
-      if not ':' in level:  levels[i]= f'{nsi}:{level}'
-    return '/'.join( levels )
+    return tbl
 
  #
  # Private method _base_request issue a GET request and returns the response.
  #
-  def _base_request( self, payload: dict ) -> requests.Response:
-    r= requests.get( base_url, params=payload )
+  def _base_request( self, payload: dict ):
     try:
+      r= self._client.get( base_url, params=payload,
+                           timeout=self.timeout or default_time_out )
       r.raise_for_status()
-    except Exception:
-      raise
+  # The message of the original exception may contain the URL of the request,
+  # which includes the web API key. Thus it is not copied into the message of
+  # the entsoeException.
+    except self._errors as e:
+      rsp= getattr( e, 'response', None )
+      if rsp is not None:
+        raise entsoeException(
+          f'Request failed: HTTP status {rsp.status_code}' ) from e
+      raise entsoeException( f'Request failed: {type(e).__name__}' ) from e
     else:
   # ENTSO-E has changed their server to also respond with 200 if there is no
   # data but all parameters are valid. This means we need to check the contents
   # for this error even when status code 200 is returned. To prevent parsing the
-  # full response, do a text matching instead of full parsing. Also only do this
-  # when response type content is text and not for example a zip file.
+  # full response, do a text matching instead of full parsing. Any other error
+  # is reported in an acknowledgement document, which is recognised and handled
+  # in the same way. Also only do this when response type content is text and
+  # not for example a zip file.
       if r.headers.get('content-type', '') == 'application/xml':
-        if 'No matching data found' in r.text:
+        if no_data_pattern.search( r.content ):
           raise entsoeException( 'No matching data found' )
+        if ack_pattern.search( r.content ):
+          mo= ack_reason.search( r.content )
+          if mo is None:
+            raise entsoeException( 'Request not acknowledged' )
+          raise entsoeException( mo.group(1).decode( errors='replace' ) )
   #
       return r
 
+ #
+ # Private method _cache_file returns the name of the file which contains the
+ # cached result of the query defined by the given period.
+ #
+  def _cache_file( self, sop: str, eop: str ) -> str:
+    return os.path.join( self.cachedir,
+                         f'{domain}_{document_type}_{sop}_{eop}.json' )
+
+ #
+ # Private method _cache_get returns the cached result of the query defined by
+ # the given period. If caching is disabled, if there is no cached result or if
+ # the cached result is expired, it returns None.
+ #
+  def _cache_get( self, sop: str, eop: str ):
+    if self.cachedir is None:  return None
+  #
+    fn= self._cache_file( sop, eop )
+    try:
+      if time.time() - os.path.getmtime( fn ) > cache_expiry:
+        os.remove( fn )
+        return None
+      with open( fn, 'r' ) as f:
+        result= json.load( f )
+      result['epl']= { int(k): v for k,v in result['epl'].items() }
+      return result
+    except Exception:
+      return None
+
+ #
+ # Private method _cache_put saves the result of the query defined by the given
+ # period in the cache, and removes any expired result from the cache. Failures
+ # are ignored, as the cache is only an optimisation.
+ #
+  def _cache_put( self, sop: str, eop: str, result: dict ):
+    if self.cachedir is None:  return
+  #
+    fn= self._cache_file( sop, eop )
+    try:
+      with open( fn + '.tmp', 'w' ) as f:
+        json.dump( result, f )
+      os.replace( fn + '.tmp', fn )
+    except Exception:
+      pass
+  #
+    prefix= f'{domain}_{document_type}_'	# Only touch files of this module
+    now   = time.time()
+    try:
+      for de in os.scandir( self.cachedir ):
+        if not de.name.startswith( prefix ):  continue
+        if not de.name.endswith( ('.json', '.json.tmp') ):  continue
+        try:
+          if now - de.stat().st_mtime > cache_expiry:
+            os.remove( de.path )
+        except OSError:
+          pass
+    except OSError:
+      pass
+
  #
  # Private method _reso_s takes a string describing the resolution. It returns
  # the resolution expressed in seconds as an integer. If the conversion fails,
@@ -128,9 +287,11 @@ class entsoe():
  #
   @staticmethod
   def _ts_last_midnight() -> int:
-    now= int( time.time() )		# Current time
-    ts = time.localtime( now )		# Determine local time in day
-    return now - ts.tm_hour*3600 - ts.tm_min*60 - ts.tm_sec
+    ts= time.localtime()		# Current local time
+  # Let mktime determine the UTC offset at midnight, which differs from the
+  # current one on the day of a DST transition.
+    return int( time.mktime( (ts.tm_year, ts.tm_mon, ts.tm_mday,
+                              0, 0, 0, 0, 0, -1) ) )
 
  #
  # Private method _ts_utc converts a time stamp, an integer number, to a string
@@ -139,21 +300,33 @@ class entsoe():
   @staticmethod
   def _ts_utc( ts: int ) -> str:
     ts= time.gmtime( ts )		# Convert to struct_time, in UTC
-    return time.strftime( time_fmt_0, ts )	# Convert to string
+    return f'{ts.tm_year:04d}{ts.tm_mon:02d}{ts.tm_mday:02d}{ts.tm_hour:02d}00'
 
  #
  # Private method _utc_ts converts a string containing a time in time zone
  # UTC. It returns the equivalent time stamp, an integer number. If the
- # conversion fails, it returns None.
+ # conversion fails, an exception is raised.
  #
   @staticmethod
   def _utc_ts( utc_time: str ) -> int:
+    s= utc_time
     try:
-      ts= time.strptime( utc_time, time_fmt_1 )	# Convert to struct_time
+      if len(s) != 17  or  s[4] != '-'  or  s[7] != '-'  or  s[10] != 'T'  or \
+         s[13] != ':'  or  s[16] != 'Z':
+        raise ValueError( 'format mismatch' )
+      fields= ( s[0:4], s[5:7], s[8:10], s[11:13], s[14:16] )
+      if not all( f.isdigit() for f in fields ):
+        raise ValueError( 'non-digit in field' )
+      yr,mo,dy,hr,mi= map( int, fields )
+      if not 1 <= mo <= 12:
+        raise ValueError( 'month out of range' )
+      if not 1 <= dy <= calendar.monthrange( yr, mo )[1]:
+        raise ValueError( 'day out of range' )
+      if hr > 23  or  mi > 59:
+        raise ValueError( 'time out of range' )
+      return calendar.timegm( (yr, mo, dy, hr, mi, 0) )
     except Exception as e:
-      raise entsoeException( f'{e}' )
-    else:
-      return calendar.timegm( ts )	# Convert to integer time stamp
+      raise entsoeException( f'Unrecognised time {utc_time}: {e}' )
 
  #
  # Private method _parse_xml_response checks and parses the xml formatted
@@ -161,26 +334,43 @@ class entsoe():
  # found, the fields of interest are extracted and retuned bundled in a dict.
  #
   def _parse_xml_response( self, xmldoc ):
-    global xmlns_id
-    result= { 'epl': {} }		# Preset result area
-    root= etree.fromstring( xmldoc )	# Build tree and get root
+    result= {}				# Preset result area
+    root= etree.fromstring( xmldoc, xml_parser )	# Build tree, get root
+    nsu = etree.QName( root ).namespace	# Name space URI of document
+    tbl = self._get_table( nsu )
   #
-    ns= {}				# Create name space dictionary
-    for k,v in root.nsmap.items():
-      if k is None:  ns[xmlns_id]= v	# Save default name space
-    if not ns:  xmlns_id= None		# Clear id if no default name space
+  # Walk once through the document. For each element with a tag of interest,
+  # check that its ancestors match the path of the field. Only the first
+  # occurrence of a scalar field is used. The subtree of a point is not walked,
+  # as its fields are accessed by index.
+    lop   = []				# List of points
+    walker= etree.iterwalk( root, events=('start',) )
+    for _,el in walker:
+      fl= tbl.get( el.tag )
+      if fl is None:  continue
+      for k,anc in fl:
+        if k in result:  continue
+        pe= el.getparent()		# Parent element
+        for tag in anc:
+          if pe is None  or  pe.tag != tag:  break
+          pe= pe.getparent()
+        else:
+          if pe is not root:  continue
+          if k == 'point':
+            lop.append( el )
+            walker.skip_subtree()
+          else:
+            result[k]= el.text
+          break
   #
     for k in xml_extract:
       fp= xml_extract[k]		# Fetch field parameters
-      xp= self._add_prefix( fp[0], xmlns_id )	# Build absolute path
-      v = root.find( xp, ns )
-      if v is None:
+      if k not in result:
         raise entsoeException( f'Unknown field: {fp[0]}' )
-      v = v.text			# Fetch field value
+      v = result[k]			# Fetch field value
       if fp[1] is not None:
         if v != fp[1]:
           raise entsoeException( f'Unexpected value: {fp[0]} = {v}' )
-      result[k]= v
   #
     unit= f'{result["unit_cur"]}/{result["unit_pmu"]}'
     if unit.endswith('WH'):  unit= unit[:-1] + 'h'
@@ -190,27 +380,26 @@ class entsoe():
     result['eop' ]= self._utc_ts( result['eop' ] )
     result['reso']= self._reso_s( result['reso'] )
   #
-    point= self._add_prefix( 'TimeSeries/Period/Point', xmlns_id )
-    index= self._add_prefix( 'position', xmlns_id )
-    price= self._add_prefix( 'price.amount', xmlns_id )
-    lop  = root.findall( point, ns )
-    for k in lop:
-      vi= int  ( k.find(index,ns).text )
-      vp= float( k.find(price,ns).text )
-      vt= result['sop'] + (vi-1)*result['reso']
-      result['epl'][vt]= vp
+    sop = result['sop' ] - result['reso']	# Time stamp of position 0
+    reso= result['reso']
+    result['epl']= { sop + int(k[0].text)*reso: float(k[1].text)
+                     for k in lop }
   #
-    for k in xml_extract:
-      if xml_extract[k][2]:		# Check clean-up flag
-        if k in result:  del result[k]
+    for k in xml_cleanup:
+      result.pop( k, None )
   #
     return result
 
  #
  # Private method _query_prices takes the start time and the end time of a
- # period and requests the electricity prices for that period.
+ # period and requests the electricity prices for that period. A cached result
+ # is returned if available, unless a refresh is forced.
  #
-  def _query_prices( self, sop: str, eop: str ):
+  def _query_prices( self, sop: str, eop: str, force_refresh: bool= False ):
+    if not force_refresh:
+      result= self._cache_get( sop, eop )
+      if result is not None:  return result
+  #
     payload= {
       'documentType' : document_type,
       'in_Domain'    : domain,
@@ -221,24 +410,26 @@ class entsoe():
     }
     r= self._base_request( payload )
 # Check r.headers["content-type"] == 'text/xml'
-    return self._parse_xml_response( r.text.encode() )
+    result= self._parse_xml_response( r.content )
+    self._cache_put( sop, eop, result )
+    return result
 
  #
  # Method query_today_prices requests the electricity prices for today, from
  # 00:00 up to tomorrow 00:00. The times are expressed in the local time-zone.
  #
-  def query_today_prices( self ):
+  def query_today_prices( self, force_refresh: bool= False ):
     tlm= self._ts_last_midnight()	# Time stamp of last midnight
     sop= self._ts_utc( tlm )		# Start of period
     eop= self._ts_utc( tlm+one_day )	# End of period
-    return self._query_prices( sop, eop )
+    return self._query_prices( sop, eop, force_refresh )
 
  #
  # Method query_day_ahead_prices requests the electricity proces for tomorrow,
  # from 00:00 until the day after tomorrow 00:00, all in the local time-zone.
  #
-  def query_day_ahead_prices( self ):
+  def query_day_ahead_prices( self, force_refresh: bool= False ):
     tnm= self._ts_last_midnight() + one_day	# Time stamp of next midnight
     sop= self._ts_utc( tnm )		# Start of period
     eop= self._ts_utc( tnm+one_day )	# End of period
-    return self._query_prices( sop, eop )
+    return self._query_prices( sop, eop, force_refresh )